@@ -1,8 +1,17 @@
 import os
+import asyncio
+import logging
+import logging.handlers
+import queue
+import sys
 from fastapi import FastAPI, Request, HTTPException
-import requests
-from collections import OrderedDict, deque
+from fastapi.responses import ORJSONResponse
+import orjson
+import httpx
+from collections import Counter, OrderedDict
+import heapq
 import time
+import xxhash
 
 # --- Configuración ---
 SCORE_SERVICE_URL = os.getenv("SCORE_SERVICE_URL", "http://localhost:8002/score")
@@ -12,6 +21,24 @@ STORAGE_SERVICE_URL = os.getenv("STORAGE_SERVICE_URL", "http://localhost:8003")
 CACHE_SIZE = int(os.getenv("CACHE_SIZE", 1000))  # Tamaño máximo de la caché
 CACHE_POLICY = os.getenv("CACHE_POLICY", "LRU")  # Política de desalojo: LRU, FIFO, LFU
 CACHE_TTL = int(os.getenv("CACHE_TTL", 0))  # TTL en segundos (0 = sin expiración)
+CACHE_SHARDS = int(os.getenv("CACHE_SHARDS", 1))  # Particiones independientes de la caché (1 = política global exacta)
+
+# Notificación de HITs en lotes hacia el storage service
+HIT_QUEUE_SIZE = int(os.getenv("HIT_QUEUE_SIZE", 10000))  # Máximo de HITs pendientes en memoria
+HIT_BATCH_SIZE = int(os.getenv("HIT_BATCH_SIZE", 256))  # Máximo de HITs por envío
+HIT_FLUSH_INTERVAL = float(os.getenv("HIT_FLUSH_INTERVAL", 0.05))  # Segundos máximos de espera para completar un lote
+
+# --- Logging ---
+# Los registros se encolan y un hilo en segundo plano los escribe en stdout,
+# así el event loop no se bloquea esperando la escritura.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+logger = logging.getLogger("cache-service")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+log_listener.start()
 
 # --- Implementación de Múltiples Políticas de Caché ---
 class CacheManager:
@@ -20,91 +47,115 @@ class CacheManager:
         self.policy = policy.upper()
         self.ttl = ttl  # Time To Live en segundos (0 = sin expiración)
         self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
-        self.timestamps = {}  # Almacena el timestamp de inserción de cada key
+        # Expiración perezosa: heap de (instante_expiración, key) y expiración vigente de cada key.
+        # Se usa time.monotonic() para no depender de saltos del reloj del sistema.
+        self.expiry_heap = []
+        self._key_expiry = {}
         
         if self.policy == "LRU":
-            self.cache = OrderedDict()
+            # dict conserva el orden de inserción: el primero es el menos reciente
+            self.cache = {}
         elif self.policy == "FIFO":
             self.cache = {}
-            self.insertion_order = deque()
+            self.insertion_order = OrderedDict()  # key -> None, en orden de inserción (remoción O(1))
         elif self.policy == "LFU":
             self.cache = {}
             self.frequencies = {}
-            self.freq_groups = {}  # frequency -> set of keys
+            self.freq_groups = {}  # frecuencia -> OrderedDict de keys (orden LRU para desempates)
             self.min_freq = 0
         else:
             raise ValueError(f"Política de caché no soportada: {policy}")
     
-    def _is_expired(self, key):
-        """Verifica si una entrada ha expirado según el TTL."""
+    def _set_expiry(self, key):
+        """Registra el instante de expiración de una key (si hay TTL)."""
         if self.ttl == 0:  # Sin expiración
-            return False
-        
-        if key not in self.timestamps:
-            return True
+            return
+        expiry = time.monotonic() + self.ttl
+        self._key_expiry[key] = expiry
+        heapq.heappush(self.expiry_heap, (expiry, key))
+    
+    def _reap_expired(self):
+        """
+        Elimina todas las entradas cuyo TTL ya venció, desde la más antigua.
+        Las entradas del heap que no coinciden con la expiración vigente de la key
+        (key actualizada o desalojada) se descartan sin más.
+        """
+        if self.ttl == 0:  # Sin expiración
+            return
         
-        elapsed = time.time() - self.timestamps[key]
-        return elapsed > self.ttl
+        now = time.monotonic()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expiry, key = heapq.heappop(self.expiry_heap)
+            if key in self.cache and self._key_expiry.get(key) == expiry:
+                self._remove_expired(key)
     
     def _remove_expired(self, key):
         """Elimina una entrada expirada."""
-        if key in self.cache:
-            del self.cache[key]
-        if key in self.timestamps:
-            del self.timestamps[key]
+        question, _ = self.cache.pop(key)
+        self._key_expiry.pop(key, None)
         
         if self.policy == "FIFO":
-            if key in self.insertion_order:
-                self.insertion_order.remove(key)
+            self.insertion_order.pop(key, None)
         elif self.policy == "LFU":
-            if key in self.frequencies:
-                freq = self.frequencies[key]
-                if freq in self.freq_groups and key in self.freq_groups[freq]:
-                    self.freq_groups[freq].remove(key)
-                    if not self.freq_groups[freq]:
-                        del self.freq_groups[freq]
-                del self.frequencies[key]
+            freq = self.frequencies.pop(key, None)
+            group = self.freq_groups.get(freq)
+            if group is not None:
+                group.pop(key, None)
+                if not group:
+                    del self.freq_groups[freq]
+                    if freq == self.min_freq:
+                        self.min_freq = min(self.freq_groups, default=0)
         
         self.stats["expirations"] += 1
-        print(f"Entrada expirada por TTL: '{key[:80]}...'")
+        logger.debug("Entrada expirada por TTL: '%.80s...'", question)
     
-    def get(self, key):
-        """Obtiene un valor de la caché según la política configurada."""
-        if key not in self.cache:
-            self.stats["misses"] += 1
-            return None
+    @staticmethod
+    def key_id(question):
+        """Hash entero (xxh3 de 64 bits) de la pregunta, usado como key interna de la caché."""
+        return xxhash.xxh3_64_intdigest(question)
+    
+    def get(self, question, key=None):
+        """
+        Obtiene un valor de la caché según la política configurada.
+        Internamente la entrada se indexa por key_id(question); si ya se calculó se puede pasar en 'key'.
+        """
+        if key is None:
+            key = self.key_id(question)
+        # Descartar primero las entradas expiradas
+        self._reap_expired()
         
-        # Verificar si ha expirado
-        if self._is_expired(key):
-            self._remove_expired(key)
+        entry = self.cache.get(key)
+        # Se compara la pregunta guardada para no confundir dos preguntas con el mismo hash
+        if entry is None or entry[0] != question:
             self.stats["misses"] += 1
             return None
         
         self.stats["hits"] += 1
         
         if self.policy == "LRU":
-            # Mover al final (más reciente)
-            self.cache.move_to_end(key)
+            # Mover al final (más reciente) reinsertando la entrada
+            self.cache[key] = self.cache.pop(key)
         elif self.policy == "LFU":
             # Incrementar frecuencia
             self._increment_frequency(key)
         # FIFO no necesita actualización en get
         
-        return self.cache[key]
+        return entry[1]
     
-    def put(self, key, value):
+    def put(self, question, value, key=None):
         """Inserta/actualiza un valor en la caché según la política configurada."""
-        # Si la entrada existe, verificar si ha expirado
-        if key in self.cache and self._is_expired(key):
-            self._remove_expired(key)
+        if key is None:
+            key = self.key_id(question)
+        # Descartar primero las entradas expiradas
+        self._reap_expired()
         
         if key in self.cache:
             # Actualizar valor existente
-            self.cache[key] = value
-            self.timestamps[key] = time.time()  # Actualizar timestamp
             if self.policy == "LRU":
-                self.cache.move_to_end(key)
-            elif self.policy == "LFU":
+                del self.cache[key]  # Reinsertar al final (más reciente)
+            self.cache[key] = (question, value)
+            self._set_expiry(key)  # Renovar TTL
+            if self.policy == "LFU":
                 self._increment_frequency(key)
             return
         
@@ -112,16 +163,16 @@ class CacheManager:
         if len(self.cache) >= self.size:
             self._evict()
         
-        self.cache[key] = value
-        self.timestamps[key] = time.time()  # Guardar timestamp de inserción
+        self.cache[key] = (question, value)
+        self._set_expiry(key)
         
         if self.policy == "FIFO":
-            self.insertion_order.append(key)
+            self.insertion_order[key] = None
         elif self.policy == "LFU":
             self.frequencies[key] = 1
             if 1 not in self.freq_groups:
-                self.freq_groups[1] = set()
-            self.freq_groups[1].add(key)
+                self.freq_groups[1] = OrderedDict()
+            self.freq_groups[1][key] = None
             self.min_freq = 1
     
     def _evict(self):
@@ -129,38 +180,38 @@ class CacheManager:
         self.stats["evictions"] += 1
         
         if self.policy == "LRU":
-            evicted_key, _ = self.cache.popitem(last=False)
+            evicted_key = next(iter(self.cache))
         elif self.policy == "FIFO":
-            evicted_key = self.insertion_order.popleft()
-            del self.cache[evicted_key]
+            evicted_key, _ = self.insertion_order.popitem(last=False)
         elif self.policy == "LFU":
-            # Encontrar y eliminar elemento con menor frecuencia
-            evicted_key = next(iter(self.freq_groups[self.min_freq]))
+            # Eliminar el elemento menos reciente entre los de menor frecuencia
+            evicted_key, _ = self.freq_groups[self.min_freq].popitem(last=False)
             if not self.freq_groups[self.min_freq]:
                 del self.freq_groups[self.min_freq]
             del self.frequencies[evicted_key]
-            del self.cache[evicted_key]
+        evicted_question, _ = self.cache.pop(evicted_key)
         
-        # Eliminar timestamp
-        if evicted_key in self.timestamps:
-            del self.timestamps[evicted_key]
+        # Eliminar expiración (la entrada del heap se descarta al vencer)
+        self._key_expiry.pop(evicted_key, None)
         
-        print(f"Caché llena. Evicción {self.policy}: '{evicted_key[:80]}...'")
+        logger.debug("Caché llena. Evicción %s: '%.80s...'", self.policy, evicted_question)
     
     def _increment_frequency(self, key):
         """Incrementa la frecuencia de un elemento (solo para LFU)."""
         old_freq = self.frequencies[key]
         new_freq = old_freq + 1
         # Remover de grupo de frecuencia anterior
-        self.freq_groups[old_freq].remove(key)
-        if not self.freq_groups[old_freq] and old_freq == self.min_freq:
-            self.min_freq += 1
+        del self.freq_groups[old_freq][key]
+        if not self.freq_groups[old_freq]:
+            del self.freq_groups[old_freq]
+            if old_freq == self.min_freq:
+                self.min_freq = new_freq
         
         # Agregar a nuevo grupo de frecuencia
         self.frequencies[key] = new_freq
         if new_freq not in self.freq_groups:
-            self.freq_groups[new_freq] = set()
-        self.freq_groups[new_freq].add(key)
+            self.freq_groups[new_freq] = OrderedDict()
+        self.freq_groups[new_freq][key] = None
     
     def get_stats(self):
         """Retorna estadísticas del caché."""
@@ -179,9 +230,120 @@ class CacheManager:
             "hit_rate": round(hit_rate, 2)
         }
 
+
+class ShardedCache:
+    """
+    Reparte las preguntas entre varios CacheManager independientes según key_id(pregunta) % N.
+    Cada partición aplica la política sobre su propio subconjunto, con una
+    capacidad que en total suma el tamaño configurado.
+    """
+    def __init__(self, size, policy, ttl=0, num_shards=1):
+        self.size = size
+        self.num_shards = max(1, min(num_shards, size))
+        base, extra = divmod(size, self.num_shards)
+        self.shards = [
+            CacheManager(base + (1 if i < extra else 0), policy, ttl)
+            for i in range(self.num_shards)
+        ]
+        self.policy = self.shards[0].policy
+        self.ttl = ttl
+    
+    def _shard(self, key):
+        return self.shards[key % self.num_shards]
+    
+    def get(self, question):
+        key = CacheManager.key_id(question)  # Se calcula una sola vez para elegir partición y buscar
+        return self._shard(key).get(question, key)
+    
+    def put(self, question, value):
+        key = CacheManager.key_id(question)
+        self._shard(key).put(question, value, key)
+    
+    def _reap_expired(self):
+        for shard in self.shards:
+            shard._reap_expired()
+    
+    def get_stats(self):
+        """Retorna estadísticas agregadas de todas las particiones."""
+        stats = {name: sum(shard.stats[name] for shard in self.shards)
+                 for name in ("hits", "misses", "evictions", "expirations")}
+        total_requests = stats["hits"] + stats["misses"]
+        hit_rate = (stats["hits"] / total_requests * 100) if total_requests > 0 else 0
+        
+        return {
+            "size": sum(len(shard.cache) for shard in self.shards),
+            "capacity": self.size,
+            "policy": self.policy,
+            "ttl": self.ttl,
+            "shards": self.num_shards,
+            **stats,
+            "hit_rate": round(hit_rate, 2)
+        }
+
 # Inicializar el gestor de caché
-cache_manager = CacheManager(CACHE_SIZE, CACHE_POLICY, CACHE_TTL)
-app = FastAPI(title="Cache Service")
+cache_manager = ShardedCache(CACHE_SIZE, CACHE_POLICY, CACHE_TTL, CACHE_SHARDS)
+app = FastAPI(title="Cache Service", default_response_class=ORJSONResponse)
+
+
+@app.on_event("startup")
+async def startup():
+    """Crea el cliente HTTP asíncrono compartido y el drenador de HITs."""
+    app.state.client = httpx.AsyncClient(timeout=15, limits=httpx.Limits(max_keepalive_connections=100))
+    app.state.hit_q = asyncio.Queue(maxsize=HIT_QUEUE_SIZE)
+    app.state.pending = {}  # pregunta -> Task con la petición al Score Service en curso
+    app.state.hit_drainer = asyncio.create_task(hit_drainer())
+    app.state.expiry_reaper = asyncio.create_task(expiry_reaper()) if CACHE_TTL > 0 else None
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.hit_drainer.cancel()
+    if app.state.expiry_reaper is not None:
+        app.state.expiry_reaper.cancel()
+    await app.state.client.aclose()
+    log_listener.stop()
+
+
+async def hit_drainer():
+    """
+    Consume la cola de HITs y los envía agrupados al storage service.
+    Un lote se cierra al llegar a HIT_BATCH_SIZE o tras HIT_FLUSH_INTERVAL segundos.
+    """
+    loop = asyncio.get_running_loop()
+    hit_q = app.state.hit_q
+    while True:
+        batch = [await hit_q.get()]
+        deadline = loop.time() + HIT_FLUSH_INTERVAL
+        while len(batch) < HIT_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(hit_q.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        hits = [{"question": q, "count": c} for q, c in Counter(batch).items()]
+        try:
+            response = await app.state.client.post(f"{STORAGE_SERVICE_URL}/hit_bulk", json={"hits": hits}, timeout=2)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning("Advertencia: No se pudieron notificar %d HITs al Storage Service. %s", len(batch), e)
+
+
+async def expiry_reaper():
+    """Elimina periódicamente (cada TTL/4) las entradas expiradas que nadie vuelve a consultar."""
+    while True:
+        await asyncio.sleep(CACHE_TTL / 4)
+        cache_manager._reap_expired()
+
+
+def notify_hit(question: str):
+    """Encola un HIT para notificarlo al storage service sin bloquear la respuesta."""
+    try:
+        app.state.hit_q.put_nowait(question)
+    except asyncio.QueueFull:
+        logger.warning("Advertencia: Cola de HITs llena, se descarta la notificación.")
 
 
 def cache_put(question: str, value):
@@ -194,6 +356,47 @@ def cache_get(question: str):
     return cache_manager.get(question)
 
 
+async def request_score(question: str, payload: dict):
+    """Obtiene la respuesta del Score Service y la guarda en la caché."""
+    try:
+        response_from_score = await app.state.client.post(SCORE_SERVICE_URL, json=payload)
+        response_from_score.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error("Error: No se pudo conectar con el Score Service. %s", e)
+        raise HTTPException(status_code=503, detail="El servicio de puntuación no está disponible.")
+    score_data = orjson.loads(response_from_score.content)
+    cache_put(question, score_data)
+    return score_data
+
+
+def _forget_pending(question: str, task: asyncio.Task):
+    """Quita la petición terminada de las pendientes y marca su excepción como consultada."""
+    if app.state.pending.get(question) is task:
+        del app.state.pending[question]
+    if not task.cancelled():
+        task.exception()
+
+
+async def fetch_score(question: str, payload: dict):
+    """
+    Obtiene la respuesta del Score Service para la pregunta.
+    Si ya hay una petición en curso para la misma pregunta, espera su resultado
+    en vez de enviar otra (una sola llamada al LLM por pregunta).
+    La llamada corre en una tarea propia: aunque el cliente que la inició se desconecte,
+    termina igual y los demás clientes reciben su resultado.
+    """
+    pending = app.state.pending
+    task = pending.get(question)
+    if task is None:
+        task = asyncio.create_task(request_score(question, payload))
+        pending[question] = task
+        task.add_done_callback(lambda t: _forget_pending(question, t))
+    else:
+        logger.debug("-> Petición al Score Service en curso para la pregunta. Esperando su resultado...")
+    # shield: si este cliente se desconecta, no se cancela la petición compartida
+    return await asyncio.shield(task)
+
+
 @app.post("/query")
 async def handle_query(request: Request):
     """
@@ -201,42 +404,32 @@ async def handle_query(request: Request):
     Verifica si la pregunta está en la caché (hit) o no (miss).
     """
     try:
-        payload = await request.json()
+        payload = orjson.loads(await request.body())
         question = payload.get("question")
 
         if not question:
             raise HTTPException(status_code=400, detail="La clave 'question' es obligatoria.")
 
-        print(f"\nRecibida pregunta: '{question[:80]}...'")
+        logger.debug("Recibida pregunta: '%.80s...'", question)
 
         # --- Lógica de la Caché ---
         cached_value = cache_get(question)
         if cached_value is not None:
             # CACHE HIT
-            print("-> Cache HIT para la pregunta.")
+            logger.debug("-> Cache HIT para la pregunta.")
             # Notificar (sin bloquear) al storage service
-            try:
-                requests.post(f"{STORAGE_SERVICE_URL}/hit", json={"question": question}, timeout=2)
-            except requests.RequestException as e:
-                print(f"Advertencia: No se pudo notificar el HIT al Storage Service. {e}")
+            notify_hit(question)
             return {"status": "hit", "message": "Respuesta obtenida desde la caché.", "data": cached_value}
         else:
             # CACHE MISS
-            print("-> Cache MISS. Enviando al Score Service...")
-            try:
-                response_from_score = requests.post(SCORE_SERVICE_URL, json=payload, timeout=15)
-                response_from_score.raise_for_status()
-                score_data = response_from_score.json()
-                cache_put(question, score_data)
-                return {"status": "miss", "data_from_score": score_data}
-            except requests.RequestException as e:
-                print(f"Error: No se pudo conectar con el Score Service. {e}")
-                raise HTTPException(status_code=503, detail="El servicio de puntuación no está disponible.")
+            logger.debug("-> Cache MISS. Enviando al Score Service...")
+            score_data = await fetch_score(question, payload)
+            return {"status": "miss", "data_from_score": score_data}
 
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error procesando la petición: {e}")
+        logger.error("Error procesando la petición: %s", e)
         raise HTTPException(status_code=500, detail="Error interno en el servidor de caché.")
 
 
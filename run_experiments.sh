@@ -38,6 +38,10 @@ fi
 echo "✓ Configuración .env verificada"
 echo ""
 
+# Los experimentos comparan la política global de la caché: sin particiones
+# (las variables del shell tienen prioridad sobre .env en docker-compose)
+export CACHE_SHARDS=1
+
 # Crear directorio para resultados
 RESULTS_DIR="resultados_experimentos"
 mkdir -p "$RESULTS_DIR"
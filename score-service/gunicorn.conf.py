@@ -0,0 +1,28 @@
+"""Configuración de gunicorn para el Score Service (workers de uvicorn)."""
+import os
+
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn.workers.UvicornWorker"
+# Pocos workers bastan: la espera al LLM es asíncrona y el modelo de similitud reparte
+# los núcleos entre ellos (SIMILARITY_THREADS en main.py); más workers solo partirían los lotes.
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+backlog = 4096
+timeout = 120  # La carga del modelo y las llamadas al LLM pueden tardar
+
+# Con el backend torch el modelo se carga una sola vez en el proceso maestro y los workers
+# lo heredan por fork(), compartiendo los pesos en vez de tener una copia cada uno.
+# Una sesión de ONNX Runtime no es segura ante fork() (su pool de hilos no se hereda),
+# así que con el backend onnx cada worker carga su propia copia del modelo int8 (~23 MB).
+preload_app = os.getenv("SIMILARITY_BACKEND", "onnx") == "torch"
+
+
+def post_fork(server, worker):
+    """
+    Reinicia el hilo de logging en cada worker (los hilos del maestro no se heredan)
+    y vuelve a fijar los hilos de torch, cuyo pool tampoco sobrevive al fork().
+    """
+    if preload_app:
+        import main
+        import torch
+        main.setup_logging()
+        torch.set_num_threads(main.SIMILARITY_THREADS)
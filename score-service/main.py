@@ -1,8 +1,17 @@
 import os
+import asyncio
+import hashlib
+import logging
+import logging.handlers
+import queue
+import sys
+from collections import OrderedDict
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+import orjson
 from sentence_transformers import SentenceTransformer, util
 import google.generativeai as genai
-import requests
+import httpx
 from dotenv import load_dotenv
 
 # Cargar variables desde .env si existe
@@ -17,10 +26,68 @@ genai.configure(api_key=GEMINI_API_KEY)
 
 STORAGE_SERVICE_URL = os.getenv("STORAGE_SERVICE_URL", "http://localhost:8003/storage")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash-lite")
+ENCODING_CACHE_SIZE = int(os.getenv("ENCODING_CACHE_SIZE", 10000))  # Máximo de embeddings en memoria
+# Micro-lotes de embeddings: textos de distintas peticiones que se codifican juntos en una sola pasada del modelo
+ENCODING_BATCH_SIZE = int(os.getenv("ENCODING_BATCH_SIZE", 64))  # Máximo de textos por lote
+ENCODING_BATCH_WINDOW = float(os.getenv("ENCODING_BATCH_WINDOW", 0.005))  # Segundos máximos de espera para completar un lote
+# Backend del modelo de similitud: "onnx" (ONNX Runtime, pesos cuantizados a int8) o "torch" (FP32 original)
+SIMILARITY_BACKEND = os.getenv("SIMILARITY_BACKEND", "onnx")
+# Variante cuantizada del modelo: la de AVX2 funciona en cualquier CPU x86-64 moderna; en CPUs con
+# AVX-512 VNNI puede usarse "onnx/model_qint8_avx512_vnni.onnx" y en arm64 "onnx/model_qint8_arm64.onnx"
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "onnx/model_quint8_avx2.onnx")
+# Hilos de cálculo del modelo por worker: por defecto los núcleos se reparten entre los workers de gunicorn
+# para que no compitan entre ellos por la CPU (cada uno usaría todos los núcleos si no se limita).
+GUNICORN_WORKERS = int(os.getenv("GUNICORN_WORKERS", 2))
+SIMILARITY_THREADS = int(os.getenv("SIMILARITY_THREADS", max(1, (os.cpu_count() or 1) // GUNICORN_WORKERS)))
 
-print("Cargando el modelo de similitud de sentencias (puede tardar)...")
-similarity_model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Modelo de similitud cargado.")
+# --- Logging ---
+# Los registros se encolan y un hilo en segundo plano los escribe en stdout,
+# así el event loop no se bloquea esperando la escritura.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logger = logging.getLogger("score-service")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_listener = None
+
+
+def setup_logging():
+    """
+    Crea la cola de logging y arranca su hilo escritor.
+    Los hilos no sobreviven a un fork, así que cada worker de gunicorn la vuelve a crear (ver gunicorn.conf.py).
+    """
+    global log_listener
+    log_queue = queue.Queue(-1)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+
+
+setup_logging()
+
+logger.info("Cargando el modelo de similitud de sentencias (puede tardar)...")
+if SIMILARITY_BACKEND == "onnx":
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = SIMILARITY_THREADS
+    session_options.inter_op_num_threads = 1
+    similarity_model = SentenceTransformer(
+        'all-MiniLM-L6-v2',
+        backend="onnx",
+        model_kwargs={
+            "file_name": ONNX_MODEL_FILE,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
+else:
+    import torch
+    torch.set_num_threads(SIMILARITY_THREADS)
+    similarity_model = SentenceTransformer('all-MiniLM-L6-v2')
+    # Con --preload el modelo se carga una vez en el proceso maestro de gunicorn; los pesos en memoria
+    # compartida permiten que todos los workers creados con fork() usen las mismas páginas físicas.
+    torch.multiprocessing.set_sharing_strategy('file_system')
+    similarity_model.share_memory()
+logger.info("Modelo de similitud cargado.")
 
 # Intentar inicializar el modelo generativo
 try:
@@ -28,47 +95,147 @@ try:
 except Exception as e:
     raise RuntimeError(f"No se pudo inicializar el modelo Gemini '{GEMINI_MODEL_NAME}': {e}")
 
-app = FastAPI(title="Score Service")
+app = FastAPI(title="Score Service", default_response_class=ORJSONResponse)
+
 
+@app.on_event("startup")
+async def startup():
+    """Crea el cliente HTTP asíncrono compartido y el agrupador de embeddings."""
+    app.state.client = httpx.AsyncClient(timeout=5, limits=httpx.Limits(max_keepalive_connections=100))
+    app.state.encoding_q = asyncio.Queue()
+    app.state.encoding_batcher = asyncio.create_task(encoding_batcher())
 
-def get_llm_answer(question: str) -> str:
-    """Envía la pregunta a la API de Gemini y retorna la respuesta generada."""
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.encoding_batcher.cancel()
+    await app.state.client.aclose()
+    log_listener.stop()
+
+
+async def get_llm_answer(question: str) -> str:
+    """
+    Envía la pregunta a la API de Gemini y retorna la respuesta generada.
+    Usa el cliente asíncrono para no ocupar el event loop ni un hilo mientras se espera la respuesta.
+    """
     try:
         prompt = f"Responde la siguiente pregunta de la forma más clara y concisa posible: {question}"
-        response = llm.generate_content(prompt)
+        response = await llm.generate_content_async(prompt)
         return getattr(response, 'text', 'Sin texto devuelto por LLM')
     except Exception as e:
-        print(f"Error al contactar la API de Gemini: {e}")
+        logger.error("Error al contactar la API de Gemini: %s", e)
         return "Error: No se pudo generar una respuesta desde el LLM."
 
 
-def calculate_similarity(text1: str, text2: str) -> float:
-    """Calcula similitud de coseno entre dos textos usando embeddings."""
-    embedding1 = similarity_model.encode(text1, convert_to_tensor=True)
-    embedding2 = similarity_model.encode(text2, convert_to_tensor=True)
-    cosine_score = util.pytorch_cos_sim(embedding1, embedding2)
-    return cosine_score.item()
+# Embeddings ya calculados (LRU), indexados por un hash del texto para acotar la memoria de las keys
+# Solo se accede desde encoding_batcher, que procesa un lote a la vez.
+encoding_cache = OrderedDict()
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def encode_texts(texts: list) -> list:
+    """
+    Retorna los embeddings de los textos reutilizando los que ya están en caché.
+    Los textos que faltan se codifican juntos en una sola pasada del modelo.
+    """
+    keys = [_text_key(text) for text in texts]
+    missing = {key: text for key, text in zip(keys, texts) if key not in encoding_cache}
+    if missing:
+        embeddings = similarity_model.encode(list(missing.values()), convert_to_tensor=True, batch_size=len(missing))
+        for key, embedding in zip(missing, embeddings):
+            encoding_cache[key] = embedding
+
+    result = []
+    for key in keys:
+        encoding_cache.move_to_end(key)
+        result.append(encoding_cache[key])
+    while len(encoding_cache) > ENCODING_CACHE_SIZE:
+        encoding_cache.popitem(last=False)
+    return result
+
+
+async def encoding_batcher():
+    """
+    Agrupa los textos pendientes de la cola y calcula sus embeddings en una sola pasada del modelo.
+    Un lote se cierra al llegar a ENCODING_BATCH_SIZE textos o tras ENCODING_BATCH_WINDOW segundos.
+    """
+    loop = asyncio.get_running_loop()
+    encoding_q = app.state.encoding_q
+    while True:
+        batch = [await encoding_q.get()]
+        deadline = loop.time() + ENCODING_BATCH_WINDOW
+        while len(batch) < ENCODING_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(encoding_q.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        texts = [text for text, _ in batch]
+        try:
+            # El modelo se ejecuta en un hilo aparte para no bloquear el event loop
+            embeddings = await asyncio.to_thread(encode_texts, texts)
+        except Exception as e:
+            # Si falla el lote, se reintenta cada texto por separado para que solo fallen
+            # las peticiones cuyo texto provoca el error y no todas las del lote.
+            logger.warning("Error al codificar un lote de %d textos, reintentando por separado: %s", len(batch), e)
+            for text, future in batch:
+                try:
+                    embedding = (await asyncio.to_thread(encode_texts, [text]))[0]
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(embedding)
+            continue
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+async def encode(text: str):
+    """Retorna el embedding de un texto (agrupado en micro-lotes con los de otras peticiones)."""
+    future = asyncio.get_running_loop().create_future()
+    await app.state.encoding_q.put((text, future))
+    return await future
 
 
 @app.post("/score")
 async def handle_scoring(request: Request):
     """Recibe pregunta y respuesta original, genera respuesta LLM y calcula score."""
     try:
-        payload = await request.json()
+        payload = orjson.loads(await request.body())
         question = payload.get("question")
         original_answer = payload.get("original_answer")
 
         if not all([question, original_answer]):
             raise HTTPException(status_code=400, detail="Faltan 'question' u 'original_answer'.")
+        if not isinstance(question, str) or not isinstance(original_answer, str):
+            raise HTTPException(status_code=400, detail="'question' y 'original_answer' deben ser texto.")
 
-        print(f"\nRecibida pregunta para scoring: '{question[:80]}...'")
-        print("Generando respuesta con el LLM...")
-        llm_answer = get_llm_answer(question)
-        print(f"Respuesta del LLM (truncada): '{llm_answer[:80]}...'")
+        logger.debug("Recibida pregunta para scoring: '%.80s...'", question)
+        logger.debug("Generando respuesta con el LLM...")
+        # El embedding de la respuesta original se calcula mientras se espera al LLM
+        original_embedding_task = asyncio.create_task(encode(original_answer))
+        try:
+            llm_answer = await get_llm_answer(question)
+        except BaseException:
+            original_embedding_task.cancel()
+            raise
+        logger.debug("Respuesta del LLM (truncada): '%.80s...'", llm_answer)
 
-        print("Calculando score de similitud...")
-        score = calculate_similarity(original_answer, llm_answer)
-        print(f"Score de similitud: {score:.4f}")
+        logger.debug("Calculando score de similitud...")
+        original_embedding = await original_embedding_task
+        llm_embedding = await encode(llm_answer)
+        score = util.pytorch_cos_sim(original_embedding, llm_embedding).item()
+        logger.debug("Score de similitud: %.4f", score)
 
         result_payload = {
             "question": question,
@@ -79,10 +246,10 @@ async def handle_scoring(request: Request):
 
         # Enviar al storage service
         try:
-            storage_response = requests.post(STORAGE_SERVICE_URL, json=result_payload, timeout=5)
+            storage_response = await app.state.client.post(STORAGE_SERVICE_URL, json=result_payload)
             storage_response.raise_for_status()
-        except requests.RequestException as e:
-            print(f"Error: No se pudo conectar con el Storage Service. {e}")
+        except httpx.HTTPError as e:
+            logger.error("Error: No se pudo conectar con el Storage Service. %s", e)
             raise HTTPException(status_code=503, detail="El servicio de almacenamiento no está disponible.")
 
         return result_payload
@@ -90,7 +257,7 @@ async def handle_scoring(request: Request):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error procesando la petición de scoring: {e}")
+        logger.error("Error procesando la petición de scoring: %s", e)
         raise HTTPException(status_code=500, detail="Error interno en el servidor de score.")
 
 
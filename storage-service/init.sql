@@ -11,3 +11,13 @@ CREATE TABLE IF NOT EXISTS responses (
 
 -- Creamos un índice en la columna 'question' para acelerar las búsquedas.
 CREATE INDEX IF NOT EXISTS idx_question ON responses (question);
+
+-- Contadores de hits separados de la tabla principal (hash de la pregunta -> hits pendientes).
+-- UNLOGGED evita escribir en el WAL; el storage service los traspasa periódicamente a responses.hit_count.
+CREATE UNLOGGED TABLE IF NOT EXISTS hit_counts (
+    h BIGINT PRIMARY KEY,
+    n BIGINT NOT NULL
+);
+
+-- Índice por el hash de la pregunta para aplicar el traspaso sin recorrer toda la tabla.
+CREATE INDEX IF NOT EXISTS idx_question_hash ON responses (hashtextextended(question, 0));